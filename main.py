@@ -1,9 +1,21 @@
 # latex_server.py - FastAPI server for LaTeX compilation
+from contextlib import asynccontextmanager
+from pathlib import Path
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import Response
-from pydantic import BaseModel
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict
+from typing import List, Optional
+import asyncio
+import base64
+import functools
+import hashlib
+import queue
+import re
+import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import os
 import logging
 
@@ -11,10 +23,283 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="LaTeX Compilation Server", version="1.0.0")
+# Content-addressed cache of compiled PDFs. Bump LATEX_CACHE_VERSION whenever
+# the TeX installation changes so stale PDFs are not served; old entries stop
+# matching any key and are evicted over time.
+CACHE_DIR = os.environ.get("LATEX_CACHE_DIR", "/var/cache/latex-server")
+PDF_CACHE_DIR = os.path.join(CACHE_DIR, "pdf")
+PDF_CACHE_MAX_BYTES = int(os.environ.get(
+    "PDF_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+PDF_CACHE_EVICT_INTERVAL = 60
+# Entries used this recently are never evicted, so a PDF that is about to be
+# served is not deleted underneath the response
+PDF_CACHE_EVICT_GRACE = 60
+CACHE_VERSION = os.environ.get("LATEX_CACHE_VERSION", "1")
+
+# pdflatex scratch space; RAM-backed by default so intermediate files never
+# touch disk. Falls back to the system temp dir if unusable.
+TMP_MIN_FREE_BYTES = 32 * 1024 * 1024
+
+# Long-lived TEXMFVAR so font maps and generated files stay warm across requests
+TEXMF_CACHE_DIR = os.path.join(CACHE_DIR, "texmf")
+
+# Commands whose output depends on the .aux file written by a previous pass;
+# documents using them get a cheap draft first pass
+NEEDS_RERUN = re.compile(
+    rb"\\((?:page|eq|auto|name|c|C|v)?ref|\w*cite\w*|tableofcontents"
+    rb"|listof\w+|bibliography|label)\b")
+MAX_PASSES = 3
+COMPILE_TIMEOUT = 30
+
+# pdflatex output scanning: TeX errors start with "!", and LaTeX (or a
+# package) asks for another pass when cross-references are not settled yet
+ERROR_LINE = re.compile(rb"^!.*$", re.MULTILINE)
+RERUN_HINT = re.compile(rb"Rerun to get|Rerun LaTeX")
+
+# /compile-batch holds every member's PDF in memory until it responds
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 16))
+
+# Read size when streaming a PDF to the client
+PDF_CHUNK_SIZE = 64 * 1024
+
+# Filenames end up in paths and in the Content-Disposition header
+SAFE_FILENAME = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+# Resolve pdflatex once instead of searching $PATH on every launch
+PDFLATEX = shutil.which("pdflatex") or "pdflatex"
+
+# Per-call arguments are the output directory and the .tex file.
+# -halt-on-error makes broken documents fail fast instead of limping on.
+PDFLATEX_ARGS_PREFIX = (
+    PDFLATEX, "-interaction=nonstopmode", "-halt-on-error", "-output-directory")
+PDFLATEX_DRAFT_ARGS_PREFIX = (
+    PDFLATEX, "-interaction=nonstopmode", "-halt-on-error", "-draftmode",
+    "-output-directory")
+
+# Bound concurrent compiles (and so pdflatex processes) to the number of cores
+PDFLATEX_SEM = asyncio.Semaphore(os.cpu_count() or 1)
+
+
+def resolve_tmp_dir():
+    """Return LATEX_TMP (default /dev/shm) if writable with enough free space"""
+    path = os.environ.get("LATEX_TMP", "/dev/shm")
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return None
+    if not os.access(path, os.W_OK):
+        return None
+    if st.f_bavail * st.f_frsize < TMP_MIN_FREE_BYTES:
+        logger.warning(f"Not enough free space in {path}, using default temp dir")
+        return None
+    return path
+
+
+TMP_DIR = resolve_tmp_dir()
+
+
+class TmpPool:
+    """
+    Reusable scratch directories for pdflatex
+    Used directories are wiped and recreated in a worker thread, so neither
+    mkdtemp nor rmtree sits on a request's critical path
+    """
+
+    def __init__(self, size, dir=None):
+        self._size = size
+        self._dir = dir
+        self._free = queue.Queue()
+        # Guards _closed against recycles still running in worker threads
+        self._lock = threading.Lock()
+        self._closed = False
+
+    async def acquire(self):
+        """Take a clean directory, creating one if none is free"""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            return await asyncio.to_thread(tempfile.mkdtemp, dir=self._dir)
+
+    def release(self, path):
+        """Hand a directory back; it is cleaned in the background"""
+        return asyncio.get_running_loop().run_in_executor(
+            None, self._recycle, path)
+
+    def _recycle(self, path):
+        shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            # Once closed, nothing drains the queue any more
+            if self._closed or self._free.qsize() >= self._size:
+                return
+            try:
+                os.mkdir(path, 0o700)
+            except OSError as e:
+                logger.warning(f"Could not recycle scratch directory: {e}")
+                return
+            self._free.put(path)
+
+    @asynccontextmanager
+    async def directory(self):
+        """Borrow a scratch directory for the duration of a block"""
+        path = await self.acquire()
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def close(self):
+        """
+        Remove all idle directories
+        Directories released afterwards are removed instead of recycled
+        """
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                path = self._free.get_nowait()
+            except queue.Empty:
+                return
+            shutil.rmtree(path, ignore_errors=True)
+
+
+TMP_POOL = TmpPool(os.cpu_count() or 1, TMP_DIR)
+
+
+def cache_key(content, filename):
+    """Hash the LaTeX source, output filename and cache version"""
+    h = hashlib.blake2b(digest_size=32)
+    for part in (CACHE_VERSION, filename, content):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def cached_pdf_path(key):
+    """Return the cached PDF path for key, or None on a cache miss"""
+    path = os.path.join(PDF_CACHE_DIR, f"{key}.pdf")
+    try:
+        # Refresh mtime so eviction treats this entry as recently used
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+
+def store_cached_pdf(key, pdf_file):
+    """
+    Atomically copy a compiled PDF into the cache
+    Returns the cached path, or None if the cache is not writable
+    Raises FileNotFoundError if pdf_file does not exist
+    """
+    with open(pdf_file, "rb") as src:
+        tmp_path = None
+        try:
+            os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=PDF_CACHE_DIR, suffix=".part")
+            # Copy rather than rename: the build directory is usually on tmpfs
+            with os.fdopen(fd, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            path = os.path.join(PDF_CACHE_DIR, f"{key}.pdf")
+            os.replace(tmp_path, path)
+            return path
+        except OSError as e:
+            logger.warning(f"Could not cache PDF: {e}")
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+
+
+def open_cached_pdf(key):
+    """
+    Open the cached PDF for key, or return None on a cache miss
+    The open handle stays readable even if the entry is evicted meanwhile
+    """
+    path = cached_pdf_path(key)
+    if path is None:
+        return None
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+
+def evict_pdf_cache(max_bytes=None):
+    """Remove least recently used PDFs until the cache fits in max_bytes"""
+    if max_bytes is None:
+        max_bytes = PDF_CACHE_MAX_BYTES
+
+    entries = []
+    total = 0
+    try:
+        with os.scandir(PDF_CACHE_DIR) as it:
+            for entry in it:
+                if not entry.name.endswith(".pdf"):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+    except FileNotFoundError:
+        return
+
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            # The entry may have been used or replaced since the scan
+            st = os.stat(path)
+            if (st.st_mtime > mtime
+                    or time.time() - st.st_mtime < PDF_CACHE_EVICT_GRACE):
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def setup_texmf_cache():
+    """Point TeX's writable cache directories at TEXMF_CACHE_DIR"""
+    try:
+        os.makedirs(TEXMF_CACHE_DIR, exist_ok=True)
+    except OSError as e:
+        logger.warning(f"Could not create TeX cache directory: {e}")
+        return
+    os.environ["TEXMFVAR"] = TEXMF_CACHE_DIR
+    os.environ["TEXMFCACHE"] = TEXMF_CACHE_DIR
+
+
+def _eviction_loop(stop):
+    while not stop.wait(PDF_CACHE_EVICT_INTERVAL):
+        try:
+            evict_pdf_cache()
+        except Exception as e:
+            logger.error(f"PDF cache eviction failed: {str(e)}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    setup_texmf_cache()
+    stop = threading.Event()
+    evictor = threading.Thread(
+        target=_eviction_loop, args=(stop,), name="pdf-cache-eviction",
+        daemon=True)
+    evictor.start()
+    yield
+    stop.set()
+    evictor.join()
+    TMP_POOL.close()
+
+
+app = FastAPI(title="LaTeX Compilation Server",
+              version="1.0.0", lifespan=lifespan)
 
 
 class LaTeXRequest(BaseModel):
+    # Pins Pydantic v2's defaults explicitly: unknown fields are dropped,
+    # strings are not stripped and assignments are not re-validated
+    model_config = ConfigDict(
+        extra="ignore", str_strip_whitespace=False, validate_assignment=False)
+
     content: str
     filename: str = "document"
 
@@ -25,82 +310,210 @@ class CompilationResult(BaseModel):
     log: str = ""
 
 
+class BatchCompilationResult(CompilationResult):
+    filename: str
+    pdf: Optional[str] = None  # base64-encoded PDF
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "pdflatex_available": check_pdflatex()}
+    return {"status": "healthy", "pdflatex_available": pdflatex_available()}
+
+
+@app.get("/health/deep")
+async def deep_health_check():
+    """Health check that actually runs pdflatex, for monitoring"""
+    available = await asyncio.to_thread(probe_pdflatex)
+    return {"status": "healthy", "pdflatex_available": available}
+
+
+def validate_filename(filename):
+    """Reject filenames that are unsafe in paths or headers"""
+    if not SAFE_FILENAME.fullmatch(filename):
+        raise HTTPException(status_code=400, detail="invalid filename")
+
+
+@functools.lru_cache(maxsize=256)
+def content_disposition(filename):
+    """Content-Disposition header value for a (validated) filename"""
+    return f"attachment; filename={filename}.pdf"
+
+
+def pdf_response(pdf, filename):
+    """
+    Stream an open PDF file as an attachment
+    Serving from the handle means eviction or scratch-directory cleanup
+    cannot pull the file out from under the response
+    """
+    size = os.fstat(pdf.fileno()).st_size
+
+    def chunks():
+        with pdf:
+            while chunk := pdf.read(PDF_CHUNK_SIZE):
+                yield chunk
+
+    return StreamingResponse(
+        chunks(),
+        media_type="application/pdf",
+        headers={"Content-Disposition": content_disposition(filename),
+                 "Content-Length": str(size)}
+    )
 
 
 def check_pdflatex():
     """Check if pdflatex is available"""
+    return shutil.which("pdflatex") is not None
+
+
+def probe_pdflatex():
+    """Check that pdflatex actually runs"""
     try:
-        result = subprocess.run(['pdflatex', '--version'],
-                                capture_output=True, text=True, timeout=5)
+        result = subprocess.run([PDFLATEX, '--version'], close_fds=False,
+                                capture_output=True, timeout=5)
         return result.returncode == 0
     except:
         return False
 
 
+@functools.lru_cache(maxsize=1)
+def pdflatex_available():
+    """Check for pdflatex once; it does not come and go at runtime"""
+    return check_pdflatex()
+
+
+async def run_pdflatex(temp_dir, tex_file, draft=False):
+    """
+    Run a single pdflatex pass without blocking the event loop
+    A draft pass only updates auxiliary files and writes no PDF.
+    Callers hold PDFLATEX_SEM for the whole compile, not per pass.
+    """
+    prefix = PDFLATEX_DRAFT_ARGS_PREFIX if draft else PDFLATEX_ARGS_PREFIX
+    args = (*prefix, temp_dir, tex_file)
+    # Our own descriptors are non-inheritable (PEP 446), so skip the
+    # close-all-fds sweep in the child
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE, close_fds=False)
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            proc.communicate(), timeout=COMPILE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise subprocess.TimeoutExpired(args, COMPILE_TIMEOUT)
+    finally:
+        # Don't leave pdflatex running after a timeout or cancellation
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
+    # Output stays as bytes; callers decode only what they actually use
+    return subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+
+
+def pdflatex_log(result):
+    """Decode the stdout and stderr of a pdflatex pass into one log"""
+    return (result.stdout + b"\n" + result.stderr).decode("utf-8", "replace")
+
+
+def write_text_file(path, content):
+    """Write a UTF-8 text file"""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def read_binary_file(path):
+    """Read a whole file as bytes"""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def pdflatex_error(result):
+    """Pick the first TeX error line ("! ...") out of a failed pass"""
+    match = ERROR_LINE.search(result.stdout)
+    if match is not None:
+        return match.group(0).decode("utf-8", "replace")
+    return result.stderr[:500].decode("utf-8", "replace") or "compile failed"
+
+
+async def compile_passes(temp_dir, tex_file, content):
+    """
+    Run pdflatex as many times as the document needs
+    Returns the result of the last (or first failing) pass
+    """
+    # When a second pass is coming anyway, the first one only has to
+    # produce the .aux file
+    draft = NEEDS_RERUN.search(content.encode("utf-8")) is not None
+
+    # Hold one slot for all passes so a multi-pass document is not queued
+    # behind newer first passes between its own passes
+    async with PDFLATEX_SEM:
+        for n in range(1, MAX_PASSES + 1):
+            logger.info(f"Running pdflatex (pass {n})")
+            result = await run_pdflatex(temp_dir, tex_file, draft=draft)
+            if result.returncode != 0:
+                break
+            # A draft pass wrote no PDF; otherwise rerun only when LaTeX asks
+            if not draft and not RERUN_HINT.search(result.stdout):
+                break
+            draft = False
+    return result
+
+
 @app.post("/compile", response_class=Response)
 async def compile_latex(request: LaTeXRequest):
     """
     Compile LaTeX content to PDF
     Returns the PDF file directly as bytes
     """
-    if not check_pdflatex():
+    validate_filename(request.filename)
+    if not pdflatex_available():
         raise HTTPException(status_code=500, detail="pdflatex not available")
 
+    # Serve identical requests straight from the cache
+    key = cache_key(request.content, request.filename)
+    cached_pdf = await asyncio.to_thread(open_cached_pdf, key)
+    if cached_pdf is not None:
+        logger.info(f"Serving cached PDF: {cached_pdf.name}")
+        return pdf_response(cached_pdf, request.filename)
+
     # Create temporary directory for compilation
-    with tempfile.TemporaryDirectory() as temp_dir:
-        tex_file = os.path.join(temp_dir, f"{request.filename}.tex")
-        pdf_file = os.path.join(temp_dir, f"{request.filename}.pdf")
+    async with TMP_POOL.directory() as temp_dir:
+        tmp = Path(temp_dir)
+        tex_file = tmp / f"{request.filename}.tex"
+        pdf_file = tmp / f"{request.filename}.pdf"
 
         try:
             # Write LaTeX content to file
             logger.info(f"Writing LaTeX content to {tex_file}")
-            with open(tex_file, "w", encoding="utf-8") as f:
-                f.write(request.content)
-
-            # Compile LaTeX (run twice for references)
-            logger.info("Running pdflatex (first pass)")
-            result1 = subprocess.run(
-                ["pdflatex", "-interaction=nonstopmode",
-                    "-output-directory", temp_dir, tex_file],
-                capture_output=True, text=True, timeout=30
-            )
+            await asyncio.to_thread(write_text_file, tex_file, request.content)
+
+            # Compile LaTeX (extra passes only for references)
+            result = await compile_passes(
+                temp_dir, tex_file, request.content)
 
-            if result1.returncode != 0:
-                logger.error(f"First pdflatex pass failed: {result1}")
+            if result.returncode != 0:
+                logger.error(f"pdflatex failed: {result}")
                 raise HTTPException(
                     status_code=400,
-                    detail=f"LaTeX compilation failed: {result1.stderr[:500]}"
+                    detail=f"LaTeX compilation failed: {pdflatex_error(result)}"
                 )
 
-            # Second pass for references
-            logger.info("Running pdflatex (second pass)")
-            subprocess.run(
-                ["pdflatex", "-interaction=nonstopmode",
-                    "-output-directory", temp_dir, tex_file],
-                capture_output=True, text=True, timeout=30
-            )
-
-            # Check if PDF was created
-            if not os.path.exists(pdf_file):
+            # pdflatex succeeded, so the PDF is only looked up by opening it.
+            # The handle outlives the scratch directory being recycled.
+            try:
+                pdf = await asyncio.to_thread(open, pdf_file, "rb")
+            except FileNotFoundError:
                 raise HTTPException(
                     status_code=500, detail="PDF file was not created")
+            try:
+                await asyncio.to_thread(store_cached_pdf, key, pdf_file)
+            except BaseException:
+                pdf.close()
+                raise
+            return pdf_response(pdf, request.filename)
 
-            # Read and return PDF
-            logger.info(f"Reading compiled PDF: {pdf_file}")
-            with open(pdf_file, "rb") as f:
-                pdf_content = f.read()
-
-            return Response(
-                content=pdf_content,
-                media_type="application/pdf",
-                headers={
-                    "Content-Disposition": f"attachment; filename={request.filename}.pdf"}
-            )
-
+        except HTTPException:
+            raise
         except subprocess.TimeoutExpired:
             raise HTTPException(
                 status_code=408, detail="LaTeX compilation timeout")
@@ -116,36 +529,109 @@ async def compile_latex_with_status(request: LaTeXRequest):
     Compile LaTeX and return status/logs instead of PDF file
     Useful for debugging
     """
-    if not check_pdflatex():
+    validate_filename(request.filename)
+    if not pdflatex_available():
         return CompilationResult(success=False, message="pdflatex not available")
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        tex_file = os.path.join(temp_dir, f"{request.filename}.tex")
-        pdf_file = os.path.join(temp_dir, f"{request.filename}.pdf")
+    async with TMP_POOL.directory() as temp_dir:
+        tmp = Path(temp_dir)
+        tex_file = tmp / f"{request.filename}.tex"
+        pdf_file = tmp / f"{request.filename}.pdf"
 
         try:
             # Write LaTeX content
-            with open(tex_file, "w", encoding="utf-8") as f:
-                f.write(request.content)
+            await asyncio.to_thread(write_text_file, tex_file, request.content)
 
             # Compile
-            result = subprocess.run(
-                ["pdflatex", "-interaction=nonstopmode",
-                    "-output-directory", temp_dir, tex_file],
-                capture_output=True, text=True, timeout=30
-            )
+            async with PDFLATEX_SEM:
+                result = await run_pdflatex(temp_dir, tex_file)
 
-            pdf_exists = os.path.exists(pdf_file)
+            success = (result.returncode == 0
+                       and await asyncio.to_thread(pdf_file.is_file))
 
             return CompilationResult(
-                success=result.returncode == 0 and pdf_exists,
-                message=f"Compilation {'successful' if result.returncode == 0 and pdf_exists else 'failed'}",
-                log=result.stdout + "\n" + result.stderr
+                success=success,
+                message=f"Compilation {'successful' if success else 'failed'}",
+                log=pdflatex_log(result)
             )
 
         except Exception as e:
             return CompilationResult(success=False, message=f"Error: {str(e)}")
 
+
+async def compile_batch_item(work_dir, request):
+    """Compile one member of a batch in its own subdirectory"""
+    def failure(message, log=""):
+        return BatchCompilationResult(
+            filename=request.filename, success=False, message=message, log=log)
+
+    def success(pdf_content, log=""):
+        return BatchCompilationResult(
+            filename=request.filename, success=True,
+            message="Compilation successful", log=log,
+            pdf=base64.b64encode(pdf_content).decode("ascii"))
+
+    if not SAFE_FILENAME.fullmatch(request.filename):
+        return failure("invalid filename")
+
+    key = cache_key(request.content, request.filename)
+    cached_pdf = await asyncio.to_thread(cached_pdf_path, key)
+    if cached_pdf is not None:
+        try:
+            return success(await asyncio.to_thread(read_binary_file, cached_pdf))
+        except FileNotFoundError:
+            # Evicted since the lookup; compile it again
+            pass
+
+    tex_file = work_dir / f"{request.filename}.tex"
+    pdf_file = work_dir / f"{request.filename}.pdf"
+
+    try:
+        await asyncio.to_thread(work_dir.mkdir)
+        await asyncio.to_thread(write_text_file, tex_file, request.content)
+
+        result = await compile_passes(
+            work_dir, tex_file, request.content)
+        log = pdflatex_log(result)
+
+        if result.returncode != 0:
+            return failure("Compilation failed", log)
+
+        try:
+            pdf_content = await asyncio.to_thread(read_binary_file, pdf_file)
+        except FileNotFoundError:
+            return failure("PDF file was not created", log)
+        await asyncio.to_thread(store_cached_pdf, key, pdf_file)
+        return success(pdf_content, log)
+
+    except subprocess.TimeoutExpired:
+        return failure("LaTeX compilation timeout")
+    except Exception as e:
+        return failure(f"Error: {str(e)}")
+
+
+@app.post("/compile-batch")
+async def compile_latex_batch(requests: List[LaTeXRequest]):
+    """
+    Compile several LaTeX documents concurrently
+    Returns a status, log and base64-encoded PDF for each document
+    """
+    if len(requests) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch too large: at most {MAX_BATCH_SIZE} documents")
+    if not pdflatex_available():
+        return [BatchCompilationResult(filename=r.filename, success=False,
+                                       message="pdflatex not available")
+                for r in requests]
+
+    async with TMP_POOL.directory() as temp_dir:
+        return await asyncio.gather(*(
+            compile_batch_item(Path(temp_dir) / str(i), request)
+            for i, request in enumerate(requests)
+        ))
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
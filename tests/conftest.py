@@ -16,3 +16,32 @@ def disable_logging():
     logging.disable(logging.CRITICAL)
     yield
     logging.disable(logging.NOTSET)
+
+
+@pytest.fixture(autouse=True)
+def isolated_pdf_cache(tmp_path, monkeypatch):
+    """Point the PDF cache at a per-test directory."""
+    cache_dir = tmp_path / "pdf-cache"
+    monkeypatch.setattr("main.PDF_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+@pytest.fixture(autouse=True)
+def reset_pdflatex_available():
+    """Forget the memoized pdflatex check between tests."""
+    from main import pdflatex_available
+    pdflatex_available.cache_clear()
+    yield
+    pdflatex_available.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def isolated_tmp_pool(tmp_path, monkeypatch):
+    """Give each test its own pool of scratch directories."""
+    from main import TmpPool
+    pool_dir = tmp_path / "tmp-pool"
+    pool_dir.mkdir()
+    pool = TmpPool(2, str(pool_dir))
+    monkeypatch.setattr("main.TMP_POOL", pool)
+    yield pool
+    pool.close()
@@ -1,16 +1,37 @@
 """Unit tests for LaTeX compilation server endpoints."""
+import asyncio
+import base64
 import os
 import pytest
 from fastapi.testclient import TestClient
 import subprocess
-from unittest.mock import patch, Mock
+from unittest.mock import patch, Mock, AsyncMock
 
-from main import app, check_pdflatex
+import main
+from main import (app, check_pdflatex, probe_pdflatex, cache_key, evict_pdf_cache,
+                  compile_passes, run_pdflatex, setup_texmf_cache,
+                  resolve_tmp_dir, PDFLATEX_ARGS_PREFIX, TmpPool)
 
 # Create a test client for the FastAPI application
 client = TestClient(app)
 
 
+async def fake_create_subprocess_exec(*args, **kwargs):
+    """Stand-in for pdflatex that fails unless the document is complete."""
+    output_dir, tex_file = args[-2], args[-1]
+    with open(tex_file, encoding="utf-8") as f:
+        ok = "\\end{document}" in f.read()
+    if ok:
+        pdf_name = os.path.basename(tex_file)[:-len(".tex")] + ".pdf"
+        with open(os.path.join(output_dir, pdf_name), "wb") as f:
+            f.write(b"PDF " + pdf_name.encode())
+
+    process = Mock()
+    process.returncode = 0 if ok else 1
+    process.communicate = AsyncMock(return_value=(b"LaTeX output", b""))
+    return process
+
+
 def test_health_check_with_pdflatex_available():
     """Test health check endpoint when pdflatex is available."""
     with patch('main.check_pdflatex', return_value=True):
@@ -29,26 +50,53 @@ def test_health_check_with_pdflatex_not_available():
                                    "pdflatex_available": False}
 
 
+def test_pdflatex_check_is_memoized():
+    """Test that /health checks pdflatex once but /health/deep every time."""
+    with patch('main.check_pdflatex', return_value=True) as mock_check, \
+            patch('main.probe_pdflatex', return_value=True) as mock_probe:
+        client.get("/health")
+        client.get("/health")
+        assert mock_check.call_count == 1
+
+        response = client.get("/health/deep")
+        client.get("/health/deep")
+        assert mock_probe.call_count == 2
+        assert response.json() == {"status": "healthy",
+                                   "pdflatex_available": True}
+
+
 def test_check_pdflatex_available():
-    """Test check_pdflatex function when pdflatex is available."""
+    """Test check_pdflatex function when pdflatex is on the PATH."""
+    with patch('shutil.which', return_value="/usr/bin/pdflatex"):
+        assert check_pdflatex() is True
+
+
+def test_check_pdflatex_not_available():
+    """Test check_pdflatex function when pdflatex is not on the PATH."""
+    with patch('shutil.which', return_value=None):
+        assert check_pdflatex() is False
+
+
+def test_probe_pdflatex_available():
+    """Test probe_pdflatex function when pdflatex runs."""
     mock_result = Mock()
     mock_result.returncode = 0
     with patch('subprocess.run', return_value=mock_result):
-        assert check_pdflatex() is True
+        assert probe_pdflatex() is True
 
 
-def test_check_pdflatex_not_available_returncode():
-    """Test check_pdflatex function when pdflatex returns non-zero."""
+def test_probe_pdflatex_not_available_returncode():
+    """Test probe_pdflatex function when pdflatex returns non-zero."""
     mock_result = Mock()
     mock_result.returncode = 1
     with patch('subprocess.run', return_value=mock_result):
-        assert check_pdflatex() is False
+        assert probe_pdflatex() is False
 
 
-def test_check_pdflatex_not_available_exception():
-    """Test check_pdflatex function when subprocess.run raises exception."""
+def test_probe_pdflatex_not_available_exception():
+    """Test probe_pdflatex function when subprocess.run raises exception."""
     with patch('subprocess.run', side_effect=Exception("Command not found")):
-        assert check_pdflatex() is False
+        assert probe_pdflatex() is False
 
 
 def test_compile_latex_no_pdflatex():
@@ -77,217 +125,585 @@ def test_compile_status_no_pdflatex():
         assert data["message"] == "pdflatex not available"
 
 
-def test_compile_latex_success():
+def test_compile_latex_success(isolated_pdf_cache):
     """Test successful LaTeX compilation."""
-    # Mock the temporary directory and file paths
-    mock_temp_dir = "/tmp/mock"
-    mock_tex_file = os.path.join(mock_temp_dir, "test.tex")
-    mock_pdf_file = os.path.join(mock_temp_dir, "test.pdf")
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec',
+                  side_effect=fake_create_subprocess_exec):
+        response = client.post(
+            "/compile",
+            json={
+                "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
+                "filename": "test"
+            }
+        )
+
+        assert response.status_code == 200
+        assert response.headers["Content-Disposition"] == "attachment; filename=test.pdf"
+        assert response.headers["Content-Type"] == "application/pdf"
+        assert response.content == b"PDF test.pdf"
+        # The PDF is served from the cache
+        assert [p.read_bytes() for p in isolated_pdf_cache.glob("*.pdf")] == [
+            b"PDF test.pdf"]
+
+
+def test_compile_latex_success_without_cache(tmp_path, monkeypatch):
+    """Test that PDFs are still served when the cache is not writable."""
+    (tmp_path / "not-a-dir").write_text("")
+    monkeypatch.setattr("main.PDF_CACHE_DIR", str(tmp_path / "not-a-dir" / "pdf"))
+    scratch = tmp_path / "scratch"
+    scratch.mkdir()
+    monkeypatch.setattr("main.TMP_DIR", str(scratch))
+
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec',
+                  side_effect=fake_create_subprocess_exec):
+        response = client.post(
+            "/compile",
+            json={
+                "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
+                "filename": "test"
+            }
+        )
+
+        assert response.status_code == 200
+        assert response.content == b"PDF test.pdf"
+        # The PDF is streamed from the build directory; nothing is left behind
+        assert list(scratch.iterdir()) == []
+
+
+def test_compile_latex_cache_entry_evicted_before_read():
+    """Test that a cache entry vanishing after lookup falls back to compiling."""
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('main.cached_pdf_path', return_value="/nonexistent/evicted.pdf"), \
+            patch('asyncio.create_subprocess_exec',
+                  side_effect=fake_create_subprocess_exec) as mock_run:
+        response = client.post(
+            "/compile",
+            json={
+                "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
+                "filename": "test"
+            }
+        )
+
+        assert response.status_code == 200
+        assert response.content == b"PDF test.pdf"
+        assert mock_run.call_count == 1
 
-    # Mock subprocess and file operations
-    with patch('tempfile.TemporaryDirectory') as mock_temp:
-        mock_temp.return_value.__enter__.return_value = mock_temp_dir
-        with patch('main.check_pdflatex', return_value=True), \
-                patch('builtins.open'), \
-                patch('os.path.exists', return_value=True), \
-                patch('subprocess.run') as mock_run:
-
-            # Mock successful compilation
-            mock_process = Mock()
-            mock_process.returncode = 0
-            mock_process.stderr = ""
-            mock_run.return_value = mock_process
-
-            # Mock file reading
-            mock_open = Mock()
-            mock_open.return_value.__enter__.return_value.read.return_value = b"PDF content"
-            with patch('builtins.open', mock_open):
-                response = client.post(
-                    "/compile",
-                    json={
-                        "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
-                        "filename": "test"
-                    }
-                )
-
-                assert response.status_code == 200
-                assert response.headers["Content-Disposition"] == "attachment; filename=test.pdf"
-                assert response.headers["Content-Type"] == "application/pdf"
+
+def test_compile_latex_cache_entry_evicted_while_streaming(isolated_pdf_cache):
+    """Test that a cached PDF evicted after it was opened is still served."""
+    content = "\\documentclass{article}\\begin{document}Test\\end{document}"
+    isolated_pdf_cache.mkdir()
+    path = isolated_pdf_cache / f"{cache_key(content, 'test')}.pdf"
+    path.write_bytes(b"cached PDF")
+
+    real_open_cached_pdf = main.open_cached_pdf
+
+    def open_then_evict(key):
+        pdf = real_open_cached_pdf(key)
+        os.remove(path)
+        return pdf
+
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('main.open_cached_pdf', side_effect=open_then_evict), \
+            patch('asyncio.create_subprocess_exec') as mock_run:
+        response = client.post(
+            "/compile", json={"content": content, "filename": "test"})
+
+        assert response.status_code == 200
+        assert response.content == b"cached PDF"
+        assert response.headers["Content-Length"] == str(len(b"cached PDF"))
+        mock_run.assert_not_called()
 
 
 def test_compile_latex_failure():
     """Test failed LaTeX compilation."""
-    # Mock the temporary directory and file paths
-    mock_temp_dir = "/tmp/mock"
-    mock_tex_file = os.path.join(mock_temp_dir, "test.tex")
-
     # Mock subprocess and file operations
-    with patch('tempfile.TemporaryDirectory') as mock_temp:
-        mock_temp.return_value.__enter__.return_value = mock_temp_dir
-        with patch('main.check_pdflatex', return_value=True), \
-                patch('builtins.open'), \
-                patch('subprocess.run') as mock_run:
-
-            # Mock failed compilation
-            mock_process = Mock()
-            mock_process.returncode = 1
-            mock_process.stderr = "LaTeX Error: Missing \\begin{document}"
-            mock_run.return_value = mock_process
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('builtins.open'), \
+            patch('asyncio.create_subprocess_exec') as mock_run:
 
-            response = client.post(
-                "/compile",
-                json={
-                    "content": "\\documentclass{article}\\begin{document",
-                    "filename": "test"
-                }
-            )
+        # Mock failed compilation
+        mock_process = Mock()
+        mock_process.returncode = 1
+        mock_process.communicate = AsyncMock(
+            return_value=(b"", b"LaTeX Error: Missing \\begin{document}"))
+        mock_run.return_value = mock_process
 
-            assert response.status_code == 400
-            assert "LaTeX compilation failed" in response.text
+        response = client.post(
+            "/compile",
+            json={
+                "content": "\\documentclass{article}\\begin{document",
+                "filename": "test"
+            }
+        )
+
+        assert response.status_code == 400
+        assert "LaTeX compilation failed" in response.text
 
 
 def test_compile_latex_timeout():
     """Test LaTeX compilation timeout."""
-    # Mock the temporary directory
-    mock_temp_dir = "/tmp/mock"
-
     # Mock subprocess and file operations
-    with patch('tempfile.TemporaryDirectory') as mock_temp:
-        mock_temp.return_value.__enter__.return_value = mock_temp_dir
-        with patch('main.check_pdflatex', return_value=True), \
-                patch('builtins.open'), \
-                patch('subprocess.run', side_effect=subprocess.TimeoutExpired("pdflatex", 30)):
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('builtins.open'), \
+            patch('main.run_pdflatex', side_effect=subprocess.TimeoutExpired("pdflatex", 30)):
 
-            response = client.post(
-                "/compile",
-                json={
-                    "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
-                    "filename": "test"
-                }
-            )
+        response = client.post(
+            "/compile",
+            json={
+                "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
+                "filename": "test"
+            }
+        )
 
-            assert response.status_code == 408
-            assert "LaTeX compilation timeout" in response.text
+        assert response.status_code == 408
+        assert "LaTeX compilation timeout" in response.text
 
 
 def test_compile_latex_pdf_not_created():
     """Test when PDF file is not created despite successful compilation."""
-    # Mock the temporary directory
-    mock_temp_dir = "/tmp/mock"
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec') as mock_run:
 
-    # Mock subprocess and file operations
-    with patch('tempfile.TemporaryDirectory') as mock_temp:
-        mock_temp.return_value.__enter__.return_value = mock_temp_dir
-        with patch('main.check_pdflatex', return_value=True), \
-                patch('builtins.open'), \
-                patch('os.path.exists', return_value=False), \
-                patch('subprocess.run') as mock_run:
-
-            # Mock successful compilation but PDF not created
-            mock_process = Mock()
-            mock_process.returncode = 0
-            mock_run.return_value = mock_process
+        # Mock successful compilation but PDF not created
+        mock_process = Mock()
+        mock_process.returncode = 0
+        mock_process.communicate = AsyncMock(return_value=(b"", b""))
+        mock_run.return_value = mock_process
 
-            response = client.post(
-                "/compile",
-                json={
-                    "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
-                    "filename": "test"
-                }
-            )
+        response = client.post(
+            "/compile",
+            json={
+                "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
+                "filename": "test"
+            }
+        )
 
-            assert response.status_code == 500
-            assert "PDF file was not created" in response.text
+        assert response.status_code == 500
+        assert "PDF file was not created" in response.text
 
 
 def test_compile_status_success():
     """Test compile-status endpoint with successful compilation."""
-    # Mock the temporary directory
-    mock_temp_dir = "/tmp/mock"
-    mock_pdf_file = os.path.join(mock_temp_dir, "test.pdf")
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec',
+                  side_effect=fake_create_subprocess_exec):
 
-    # Mock subprocess and file operations
-    with patch('tempfile.TemporaryDirectory') as mock_temp:
-        mock_temp.return_value.__enter__.return_value = mock_temp_dir
-        with patch('main.check_pdflatex', return_value=True), \
-                patch('builtins.open'), \
-                patch('os.path.exists', return_value=True), \
-                patch('subprocess.run') as mock_run:
-
-            # Mock successful compilation
-            mock_process = Mock()
-            mock_process.returncode = 0
-            mock_process.stdout = "LaTeX output"
-            mock_process.stderr = ""
-            mock_run.return_value = mock_process
-
-            response = client.post(
-                "/compile-status",
-                json={
-                    "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
-                    "filename": "test"
-                }
-            )
+        response = client.post(
+            "/compile-status",
+            json={
+                "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
+                "filename": "test"
+            }
+        )
 
-            assert response.status_code == 200
-            data = response.json()
-            assert data["success"] is True
-            assert data["message"] == "Compilation successful"
-            assert "LaTeX output" in data["log"]
+        assert response.status_code == 200
+        data = response.json()
+        assert data["success"] is True
+        assert data["message"] == "Compilation successful"
+        assert "LaTeX output" in data["log"]
 
 
 def test_compile_status_failure():
     """Test compile-status endpoint with failed compilation."""
-    # Mock the temporary directory
-    mock_temp_dir = "/tmp/mock"
-
     # Mock subprocess and file operations
-    with patch('tempfile.TemporaryDirectory') as mock_temp:
-        mock_temp.return_value.__enter__.return_value = mock_temp_dir
-        with patch('main.check_pdflatex', return_value=True), \
-                patch('builtins.open'), \
-                patch('os.path.exists', return_value=False), \
-                patch('subprocess.run') as mock_run:
-
-            # Mock failed compilation
-            mock_process = Mock()
-            mock_process.returncode = 1
-            mock_process.stdout = ""
-            mock_process.stderr = "LaTeX Error"
-            mock_run.return_value = mock_process
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('builtins.open'), \
+            patch('asyncio.create_subprocess_exec') as mock_run:
 
-            response = client.post(
-                "/compile-status",
-                json={
-                    "content": "\\documentclass{article}\\begin{document",
-                    "filename": "test"
-                }
-            )
+        # Mock failed compilation
+        mock_process = Mock()
+        mock_process.returncode = 1
+        mock_process.communicate = AsyncMock(
+            return_value=(b"", b"LaTeX Error"))
+        mock_run.return_value = mock_process
+
+        response = client.post(
+            "/compile-status",
+            json={
+                "content": "\\documentclass{article}\\begin{document",
+                "filename": "test"
+            }
+        )
 
-            assert response.status_code == 200
-            data = response.json()
-            assert data["success"] is False
-            assert data["message"] == "Compilation failed"
-            assert "LaTeX Error" in data["log"]
+        assert response.status_code == 200
+        data = response.json()
+        assert data["success"] is False
+        assert data["message"] == "Compilation failed"
+        assert "LaTeX Error" in data["log"]
 
 
 def test_compile_status_exception():
     """Test compile-status endpoint when an exception occurs."""
-    # Mock the temporary directory
-    with patch('tempfile.TemporaryDirectory') as mock_temp:
-        mock_temp.return_value.__enter__.return_value = "/tmp/mock"
-        with patch('main.check_pdflatex', return_value=True), \
-                patch('builtins.open', side_effect=Exception("Mock error")):
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('builtins.open', side_effect=Exception("Mock error")):
+
+        response = client.post(
+            "/compile-status",
+            json={
+                "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
+                "filename": "test"
+            }
+        )
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["success"] is False
+        assert "Error: Mock error" in data["message"]
+
+
+def test_cache_key_depends_on_content_and_filename():
+    """Test cache keys differ by content and filename but are stable."""
+    key = cache_key("content", "doc")
+    assert key == cache_key("content", "doc")
+    assert key != cache_key("content", "other")
+    assert key != cache_key("other content", "doc")
+
+
+def test_compile_latex_cache_hit(isolated_pdf_cache):
+    """Test that a cached PDF is served without running pdflatex."""
+    content = "\\documentclass{article}\\begin{document}Test\\end{document}"
+    isolated_pdf_cache.mkdir()
+    (isolated_pdf_cache / f"{cache_key(content, 'test')}.pdf").write_bytes(
+        b"cached PDF")
+
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec') as mock_run:
+        response = client.post(
+            "/compile", json={"content": content, "filename": "test"})
+
+        assert response.status_code == 200
+        assert response.content == b"cached PDF"
+        assert response.headers["Content-Disposition"] == "attachment; filename=test.pdf"
+        mock_run.assert_not_called()
+
+
+def test_evict_pdf_cache_removes_least_recently_used(isolated_pdf_cache):
+    """Test eviction removes the oldest entries until under budget."""
+    isolated_pdf_cache.mkdir()
+    for i, name in enumerate(["old", "mid", "new"]):
+        path = isolated_pdf_cache / f"{name}.pdf"
+        path.write_bytes(b"x" * 10)
+        os.utime(path, (1000 + i, 1000 + i))
+
+    evict_pdf_cache(max_bytes=20)
+
+    assert sorted(p.name for p in isolated_pdf_cache.iterdir()) == [
+        "mid.pdf", "new.pdf"]
+
+
+def test_evict_pdf_cache_skips_recently_used(isolated_pdf_cache):
+    """Test eviction never removes entries used within the grace period."""
+    isolated_pdf_cache.mkdir()
+    old = isolated_pdf_cache / "old.pdf"
+    old.write_bytes(b"x" * 10)
+    os.utime(old, (1000, 1000))
+    # Touched by a cache hit just now
+    (isolated_pdf_cache / "fresh.pdf").write_bytes(b"x" * 10)
+
+    evict_pdf_cache(max_bytes=0)
+
+    assert [p.name for p in isolated_pdf_cache.iterdir()] == ["fresh.pdf"]
+
+
+def test_evict_pdf_cache_rechecks_mtime_before_removing(isolated_pdf_cache):
+    """Test that an entry touched after the scan is not evicted."""
+    isolated_pdf_cache.mkdir()
+    path = isolated_pdf_cache / "hit.pdf"
+    path.write_bytes(b"x" * 10)
+    os.utime(path, (1000, 1000))
+
+    real_stat = os.stat
+
+    def stat_after_touch(p, *args, **kwargs):
+        # Simulate cached_pdf_path() touching the entry mid-eviction
+        if str(p) == str(path):
+            os.utime(path, (2000, 2000))
+        return real_stat(p, *args, **kwargs)
+
+    with patch('os.stat', side_effect=stat_after_touch):
+        evict_pdf_cache(max_bytes=0)
+
+    assert path.exists()
+
+
+def test_compile_passes_single_pass_without_references():
+    """Test that documents without cross-references compile in one pass."""
+    mock_process = Mock()
+    mock_process.returncode = 0
+    mock_process.stdout = b"Output written on test.pdf"
+    with patch('main.run_pdflatex', return_value=mock_process) as mock_run:
+        asyncio.run(compile_passes(
+            "/tmp/mock", "/tmp/mock/test.tex",
+            "\\documentclass{article}\\begin{document}Test\\end{document}"))
+        assert mock_run.call_count == 1
+        assert mock_run.call_args.kwargs["draft"] is False
+
+
+def test_compile_passes_hyperlinks_stay_single_pass():
+    """Test that \\href and \\hyperref alone do not trigger a draft pass."""
+    mock_process = Mock()
+    mock_process.returncode = 0
+    mock_process.stdout = b"Output written on test.pdf"
+    content = ("\\documentclass{article}\\usepackage{hyperref}\\begin{document}"
+               "\\href{https://example.com}{link} \\hyperref[x]{text}\\end{document}")
+    with patch('main.run_pdflatex', return_value=mock_process) as mock_run:
+        asyncio.run(compile_passes("/tmp/mock", "/tmp/mock/test.tex", content))
+        assert mock_run.call_count == 1
+        assert mock_run.call_args.kwargs["draft"] is False
+
+
+def test_compile_passes_draft_pass_for_references():
+    """Test that documents with references get a draft pass then a full one."""
+    mock_process = Mock()
+    mock_process.returncode = 0
+    mock_process.stdout = b"Output written on test.pdf"
+    content = "\\section{A}\\label{a} See \\pageref{a}."
+    with patch('main.run_pdflatex', return_value=mock_process) as mock_run:
+        asyncio.run(compile_passes("/tmp/mock", "/tmp/mock/test.tex", content))
+        assert [c.kwargs["draft"] for c in mock_run.call_args_list] == [
+            True, False]
+
+
+def test_compile_passes_holds_semaphore_across_passes():
+    """Test that all passes of one document run under a single slot."""
+    mock_process = Mock()
+    mock_process.returncode = 0
+    mock_process.stdout = b"Output written on test.pdf"
+    sem = Mock()
+    sem.__aenter__ = AsyncMock()
+    sem.__aexit__ = AsyncMock(return_value=False)
+    content = "\\section{A}\\label{a} See \\ref{a}."
+    with patch('main.PDFLATEX_SEM', sem), \
+            patch('main.run_pdflatex', return_value=mock_process) as mock_run:
+        asyncio.run(compile_passes("/tmp/mock", "/tmp/mock/test.tex", content))
+        assert mock_run.call_count == 2
+        assert sem.__aenter__.await_count == 1
+
+
+def test_compile_passes_reruns_when_latex_asks():
+    """Test that pdflatex's rerun warning triggers another pass."""
+    rerun = Mock(returncode=0, stdout=b"LaTeX Warning: Label(s) may have "
+                 b"changed. Rerun to get cross-references right.")
+    done = Mock(returncode=0, stdout=b"Output written on test.pdf")
+    with patch('main.run_pdflatex', side_effect=[rerun, done]) as mock_run:
+        asyncio.run(compile_passes(
+            "/tmp/mock", "/tmp/mock/test.tex",
+            "\\documentclass{article}\\begin{document}Test\\end{document}"))
+        assert mock_run.call_count == 2
+
+    with patch('main.run_pdflatex', return_value=rerun) as mock_run:
+        asyncio.run(compile_passes(
+            "/tmp/mock", "/tmp/mock/test.tex",
+            "\\documentclass{article}\\begin{document}Test\\end{document}"))
+        assert mock_run.call_count == 3
+
+
+def test_compile_latex_failure_reports_tex_error():
+    """Test that the first TeX error line is reported on failure."""
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec') as mock_run:
+        mock_process = Mock()
+        mock_process.returncode = 1
+        mock_process.communicate = AsyncMock(return_value=(
+            b"(./test.tex\n! Undefined control sequence.\nl.3 \\foo\n", b""))
+        mock_run.return_value = mock_process
+
+        response = client.post(
+            "/compile",
+            json={"content": "\\documentclass{article}\\begin{document}\\foo",
+                  "filename": "test"}
+        )
+
+        assert response.status_code == 400
+        assert response.json()["detail"] == (
+            "LaTeX compilation failed: ! Undefined control sequence.")
+
+
+def test_run_pdflatex_args():
+    """Test the pdflatex command line for full and draft passes."""
+    mock_process = Mock()
+    mock_process.returncode = 0
+    mock_process.communicate = AsyncMock(return_value=(b"", b""))
+    with patch('asyncio.create_subprocess_exec',
+               return_value=mock_process) as mock_run:
+        asyncio.run(run_pdflatex("/tmp/mock", "/tmp/mock/test.tex"))
+        args = mock_run.call_args.args
+        assert args == (*PDFLATEX_ARGS_PREFIX, "/tmp/mock", "/tmp/mock/test.tex")
+        assert args[0] == main.PDFLATEX
+        assert "-halt-on-error" in args
+        assert "-draftmode" not in args
+        assert mock_run.call_args.kwargs["close_fds"] is False
+
+        asyncio.run(run_pdflatex("/tmp/mock", "/tmp/mock/test.tex", draft=True))
+        assert "-draftmode" in mock_run.call_args.args
+
+
+def test_run_pdflatex_timeout_kills_process():
+    """Test that a timed out pdflatex process is killed."""
+    mock_process = Mock()
+    mock_process.returncode = None
+    mock_process.communicate = AsyncMock(side_effect=asyncio.TimeoutError)
+    mock_process.wait = AsyncMock()
+    with patch('asyncio.create_subprocess_exec', return_value=mock_process):
+        with pytest.raises(subprocess.TimeoutExpired):
+            asyncio.run(run_pdflatex("/tmp/mock", "/tmp/mock/test.tex"))
+    mock_process.kill.assert_called_once()
+
+
+def test_compile_batch():
+    """Test batch endpoint reports per-document status and PDFs."""
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec',
+                  side_effect=fake_create_subprocess_exec):
+        response = client.post(
+            "/compile-batch",
+            json=[
+                {"content": "\\documentclass{article}\\begin{document}A\\end{document}",
+                 "filename": "a"},
+                {"content": "\\documentclass{article}\\begin{document",
+                 "filename": "b"},
+            ]
+        )
+
+        assert response.status_code == 200
+        data = response.json()
+        assert [r["filename"] for r in data] == ["a", "b"]
+        assert data[0]["success"] is True
+        assert base64.b64decode(data[0]["pdf"]) == b"PDF a.pdf"
+        assert data[1]["success"] is False
+        assert data[1]["message"] == "Compilation failed"
+        assert data[1]["pdf"] is None
+
+
+def test_compile_batch_cache_entry_evicted_before_read():
+    """Test that a cache entry vanishing after lookup falls back to compiling."""
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('main.cached_pdf_path', return_value="/nonexistent/evicted.pdf"), \
+            patch('asyncio.create_subprocess_exec',
+                  side_effect=fake_create_subprocess_exec):
+        response = client.post(
+            "/compile-batch",
+            json=[{"content": "\\documentclass{article}\\begin{document}A\\end{document}",
+                   "filename": "a"}]
+        )
 
+        assert response.status_code == 200
+        data = response.json()
+        assert data[0]["success"] is True
+        assert base64.b64decode(data[0]["pdf"]) == b"PDF a.pdf"
+
+
+def test_compile_batch_too_large():
+    """Test that batches over MAX_BATCH_SIZE are rejected up front."""
+    with patch('main.MAX_BATCH_SIZE', 2), \
+            patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec') as mock_run:
+        response = client.post(
+            "/compile-batch",
+            json=[{"content": "x", "filename": f"d{i}"} for i in range(3)])
+
+        assert response.status_code == 413
+        assert "Batch too large" in response.text
+        mock_run.assert_not_called()
+
+
+def test_compile_batch_no_pdflatex():
+    """Test batch endpoint when pdflatex is not available."""
+    with patch('main.check_pdflatex', return_value=False):
+        response = client.post(
+            "/compile-batch", json=[{"content": "x", "filename": "a"}])
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data[0]["success"] is False
+        assert data[0]["message"] == "pdflatex not available"
+
+
+def test_setup_texmf_cache(tmp_path, monkeypatch):
+    """Test that TeX's cache variables point at a persistent directory."""
+    texmf_dir = tmp_path / "texmf"
+    monkeypatch.setattr("main.TEXMF_CACHE_DIR", str(texmf_dir))
+    monkeypatch.delenv("TEXMFVAR", raising=False)
+    monkeypatch.delenv("TEXMFCACHE", raising=False)
+
+    setup_texmf_cache()
+
+    assert texmf_dir.is_dir()
+    assert os.environ["TEXMFVAR"] == str(texmf_dir)
+    assert os.environ["TEXMFCACHE"] == str(texmf_dir)
+
+
+def test_resolve_tmp_dir(tmp_path, monkeypatch):
+    """Test scratch directory selection from LATEX_TMP."""
+    monkeypatch.setenv("LATEX_TMP", str(tmp_path))
+    assert resolve_tmp_dir() == str(tmp_path)
+
+    monkeypatch.setenv("LATEX_TMP", str(tmp_path / "missing"))
+    assert resolve_tmp_dir() is None
+
+
+@pytest.mark.parametrize("filename", ["../etc/passwd", "a b", "x" * 65, "doc\n", ""])
+def test_invalid_filename_rejected(filename):
+    """Test that unsafe filenames are rejected before compiling."""
+    content = "\\documentclass{article}\\begin{document}Test\\end{document}"
+    with patch('main.check_pdflatex', return_value=True), \
+            patch('asyncio.create_subprocess_exec') as mock_run:
+        for endpoint in ("/compile", "/compile-status"):
             response = client.post(
-                "/compile-status",
-                json={
-                    "content": "\\documentclass{article}\\begin{document}Test\\end{document}",
-                    "filename": "test"
-                }
-            )
-
-            assert response.status_code == 200
-            data = response.json()
-            assert data["success"] is False
-            assert "Error: Mock error" in data["message"]
+                endpoint, json={"content": content, "filename": filename})
+            assert response.status_code == 400
+            assert "invalid filename" in response.text
+
+        response = client.post(
+            "/compile-batch", json=[{"content": content, "filename": filename}])
+        assert response.status_code == 200
+        assert response.json()[0]["message"] == "invalid filename"
+
+        mock_run.assert_not_called()
+
+
+def test_tmp_pool_reuses_cleaned_directories(tmp_path):
+    """Test that released directories are wiped and handed out again."""
+    pool = TmpPool(1, str(tmp_path))
+
+    async def borrow_twice():
+        first = await pool.acquire()
+        with open(os.path.join(first, "test.aux"), "w") as f:
+            f.write("stale")
+        await pool.release(first)
+        second = await pool.acquire()
+        return first, second
+
+    first, second = asyncio.run(borrow_twice())
+    assert first == second
+    assert os.listdir(second) == []
+
+    # Directories beyond the pool size are removed, not kept
+    async def borrow_two():
+        a, b = await pool.acquire(), await pool.acquire()
+        await pool.release(a)
+        await pool.release(b)
+        return a, b
+
+    a, b = asyncio.run(borrow_two())
+    assert os.path.isdir(a) != os.path.isdir(b)
+
+
+def test_tmp_pool_close_removes_late_releases(tmp_path):
+    """Test that directories released after close() are not kept."""
+    pool_dir = tmp_path / "closing-pool"
+    pool_dir.mkdir()
+    pool = TmpPool(2, str(pool_dir))
+
+    async def release_after_close():
+        path = await pool.acquire()
+        pool.close()
+        await pool.release(path)
+        return path
+
+    path = asyncio.run(release_after_close())
+    assert not os.path.exists(path)
+    assert os.listdir(pool_dir) == []